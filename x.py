@@ -1,16 +1,32 @@
 import streamlit as st
 import pandas as pd
-import re, io
+import numpy as np
+import re, io, math
 import plotly.express as px
-from openpyxl import load_workbook
-from openpyxl.styles import PatternFill, Font, Alignment, Border, Side
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import PatternFill, Font, Alignment, Border, Side, NamedStyle
 from openpyxl.utils import get_column_letter
+from openpyxl.formatting.rule import FormulaRule
 
 # ====== CONFIG ======
 HEADER_SEARCH_ROWS = 30
-AMOUNT_PATTERN = re.compile(r'(AMOUNT|AMT|AED)', re.IGNORECASE)
-QTY_PATTERN    = re.compile(r'(QUANTITY|QTY)', re.IGNORECASE)
-RATE_PATTERN   = re.compile(r'(RATE|UNIT RATE)', re.IGNORECASE)
+# Column kinds by header keyword; a header can hit several kinds (e.g. "Rate (AED)")
+COLUMN_PATTERN = re.compile(r'(?P<amt>AMOUNT|AMT|AED)|(?P<rate>RATE)|(?P<qty>QUANTITY|QTY)', re.IGNORECASE)
+
+# Header detection: each keyword scores 1 per cell, an amount cell scores 2 and is required
+HEADER_KEYWORDS = [re.compile(p) for p in (r'ITEM', r'DESC', r'RATE', r'UNIT', r'QUANTITY|QTY')]
+HEADER_AMOUNT   = re.compile(r'AMOUNT|^AED$|\bAMT\b')
+
+# Cell text pd.read_excel reads as missing by default
+NA_STRINGS = {"", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+              "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null"}
+
+# Numeric coercion: strip common BoQ formatting first, regex only as fallback
+_STRIP = str.maketrans('', '', ' ,AED$€₹\t')
+_CLEAN = re.compile(r'[^\d.\-]')
 
 # Colors
 GREEN_FILL  = PatternFill(start_color="FF00FF00", end_color="FF00FF00", fill_type="solid")  # lowest
@@ -18,6 +34,8 @@ RED_FILL    = PatternFill(start_color="FFFF0000", end_color="FFFF0000", fill_typ
 YELLOW_FILL = PatternFill(start_color="FFFFFF00", end_color="FFFFFF00", fill_type="solid")  # missing
 BLUE_FILL   = PatternFill(start_color="FF0000FF", end_color="FF0000FF", fill_type="solid")  # mismatch
 HEADER_FILL = PatternFill(start_color="FFD9D9D9", end_color="FFD9D9D9", fill_type="solid")  # header
+HEADER_FONT = Font(bold=True, color="000000")
+HEADER_ALIGNMENT = Alignment(horizontal="center", vertical="center")
 
 # Borders
 thin_border = Border(
@@ -26,26 +44,78 @@ thin_border = Border(
     top=Side(style='thin', color='000000'),
     bottom=Side(style='thin', color='000000')
 )
+BORDERED_STYLE = "bordered"  # named style registered on each output workbook
 
 # ====== HELPERS ======
+def sheet_frame(rows):
+    """
+    Build a DataFrame from raw sheet rows, first row as header.
+    Follows pd.read_excel: blank headers become "Unnamed: i", repeated headers
+    get ".1", ".2", ... suffixes the way pandas picks them, and NA_STRINGS cells become NaN.
+    """
+    rows = list(rows)
+    while rows and all(v is None for v in rows[-1]):
+        rows.pop()
+    if not rows:
+        return pd.DataFrame()
+
+    # iter_rows stops each row at its last stored cell, so pad every row to the widest
+    width = max(len(r) for r in rows)
+    header, *body = [tuple(r) + (None,) * (width - len(r)) for r in rows]
+    columns = [f"Unnamed: {i}" if h is None else h for i, h in enumerate(header)]
+    counts = {}
+    # same walk as pandas' parser: named headers first, then blanks, skipping
+    # suffixes already taken anywhere in the header
+    for i in sorted(range(width), key=lambda i: header[i] is None):
+        name = columns[i]
+        n, col = counts.get(name, 0), name
+        while n > 0:
+            counts[name] = n + 1
+            col = f"{name}.{n}"
+            n = n + 1 if col in columns else counts.get(col, 0)
+        columns[i] = col
+        counts[col] = n + 1
+    df = pd.DataFrame(body, columns=columns, dtype=object)
+    return df.mask(df.isin(NA_STRINGS))
+
+@st.cache_data(show_spinner=False)
+def parse_workbook(file_bytes: bytes):
+    """Read every sheet of an uploaded xlsx into {sheet_name: DataFrame} (cached across reruns)."""
+    wb = load_workbook(io.BytesIO(file_bytes), read_only=True, data_only=True)
+    try:
+        book = {}
+        for ws in wb.worksheets:
+            # read-only sheets trust the stored <dimension>, which some exporters leave stale
+            ws.reset_dimensions()
+            book[ws.title] = sheet_frame(ws.iter_rows(values_only=True))
+        return book
+    finally:
+        wb.close()
+
+def load_upload(uf):
+    """Parse one uploaded file; returns (name, sheets, error) so errors can be shown on the main thread."""
+    try:
+        return uf.name, parse_workbook(uf.getvalue()), None
+    except Exception as e:
+        return uf.name, None, e
+
 def detect_header_row(df0: pd.DataFrame):
     """Find likely header row (returns 0-based row index)."""
-    best_row, best_score = None, -1
-    for r in range(min(HEADER_SEARCH_ROWS, len(df0))):
-        row_vals = df0.iloc[r].astype(str).str.strip().str.upper().tolist()
-        score, has_amount = 0, False
-        for v in row_vals:
-            if "ITEM" in v: score += 1
-            if "DESC" in v or "DESCRIPTION" in v: score += 1
-            if "RATE" in v: score += 1
-            if "UNIT" in v: score += 1
-            if "QUANTITY" in v or "QTY" in v: score += 1
-            if "AMOUNT" in v or v == "AED" or re.search(r'\bAMT\b', v):
-                score += 2
-                has_amount = True
-        if has_amount and score > best_score:
-            best_score, best_row = score, r
-    return best_row
+    block = df0.head(HEADER_SEARCH_ROWS)
+    if block.empty:
+        return None
+    shape = block.shape
+    cells = pd.Series(block.to_numpy(dtype=str).ravel()).str.strip().str.upper()
+
+    is_amount = cells.str.contains(HEADER_AMOUNT).to_numpy().reshape(shape)
+    has_amount = is_amount.any(axis=1)
+    if not has_amount.any():
+        return None
+    score = 2 * is_amount.sum(axis=1)
+    for pattern in HEADER_KEYWORDS:
+        score += cells.str.contains(pattern).to_numpy().reshape(shape).sum(axis=1)
+    # first best-scoring row wins, as before
+    return int(np.argmax(np.where(has_amount, score, -1)))
 
 def to_number(x):
     """Convert cell value to float if possible"""
@@ -53,44 +123,118 @@ def to_number(x):
         return None
     try:
         if isinstance(x, str):
-            s = re.sub(r'[^\d\.\-]', '', x.strip())
+            try:
+                v = float(x.translate(_STRIP))
+                if math.isfinite(v):
+                    return v
+            except ValueError:
+                pass
+            s = _CLEAN.sub('', x)
             if not s:
                 return None
             return float(s)
         return float(x)
-    except:
+    except (TypeError, ValueError):
         return None
 
-def style_worksheet(ws, header_row):
+def to_numbers(values):
+    """Convert a sequence of cell values to a float array (NaN where not numeric)"""
+    # plain numeric / blank columns convert in one go; text always goes through
+    # to_number, since NumPy would also accept strings like "inf"
+    if not any(isinstance(x, str) for x in values):
+        try:
+            return np.array(values, dtype=float)
+        except (TypeError, ValueError):
+            pass
+    return np.array([to_number(x) for x in values], dtype=float)
+
+def frame_rows(df: pd.DataFrame):
+    """Header + data rows of a DataFrame as plain lists (blanks as None)."""
+    values = df.to_numpy(dtype=object)
+    values[pd.isna(values)] = None
+    return [list(df.columns)] + values.tolist()
+
+def text_rows(data, cols):
+    """Mask of data rows holding text (or booleans) in any of cols (1-based); Excel's COUNT/MIN/MAX skip these."""
+    return np.array([any(isinstance(row[c - 1], (str, bool)) for c in cols) for row in data], dtype=bool)
+
+def add_highlight_rules(ws, amount_cols, first_row, last_row, rate_col=None, qty_col=None):
+    """
+    Colour Lowest/Highest/Missing amounts and Rate x Qty mismatches with conditional
+    formatting, so Excel evaluates them on open instead of us filling every cell.
+    Rules added first win, matching the old fill order (mismatch over min/max).
+    Rules only apply to rows whose compared cells are all numbers or blank;
+    rows with text there (e.g. "AED 1,250") get static fills instead, see text_rows.
+    """
+    letters = [get_column_letter(c) for c in amount_cols]
+    ranges = " ".join(f"{L}{first_row}:{L}{last_row}" for L in letters)
+    cell = f"{letters[0]}{first_row}"  # formulas are relative to the first cell of the range
+    row_vals = ",".join(f"${L}{first_row}" for L in letters)
+    compared = row_vals
+
+    if rate_col and qty_col:
+        rate = f"${get_column_letter(rate_col)}{first_row}"
+        qty = f"${get_column_letter(qty_col)}{first_row}"
+        compared += f",{rate},{qty}"
+    numeric_row = f"COUNTA({compared})=COUNT({compared})"
+
+    if rate_col and qty_col:
+        ws.conditional_formatting.add(f"{cell}:{letters[0]}{last_row}", FormulaRule(
+            formula=[f"AND({numeric_row},ISNUMBER({cell}),ISNUMBER({rate}),ISNUMBER({qty}),"
+                     f"ABS({rate}*{qty}-{cell})>0.000001)"],
+            fill=BLUE_FILL))
+    ws.conditional_formatting.add(ranges, FormulaRule(
+        formula=[f"AND({numeric_row},NOT(ISNUMBER({cell})),COUNT({row_vals})>0)"], fill=YELLOW_FILL))
+    ws.conditional_formatting.add(ranges, FormulaRule(
+        formula=[f"AND({numeric_row},ISNUMBER({cell}),{cell}=MIN({row_vals}))"], fill=GREEN_FILL))
+    ws.conditional_formatting.add(ranges, FormulaRule(
+        formula=[f"AND({numeric_row},ISNUMBER({cell}),{cell}=MAX({row_vals}))"], fill=RED_FILL))
+
+def make_cell(ws, value, fill=None):
+    """Bordered WriteOnlyCell holding value, with an optional highlight fill."""
+    cell = WriteOnlyCell(ws, value)
+    cell.style = BORDERED_STYLE
+    if fill is not None:
+        cell.fill = fill
+    return cell
+
+def header_cell(ws, value):
+    """WriteOnlyCell holding value, styled as a header."""
+    cell = make_cell(ws, value, HEADER_FILL)
+    cell.font = HEADER_FONT
+    cell.alignment = HEADER_ALIGNMENT
+    return cell
+
+def write_styled_sheet(ws, rows, header_row, fills):
     """
-    Apply formatting and freeze header.
+    Stream rows into a write-only worksheet with formatting and frozen header.
     header_row here should be the Excel 1-based header row (e.g. 5),
     and we will freeze the row below (A{header_row+1}) so header stays visible.
+    fills maps (row, col) -> highlight fill.
     """
-    for row in ws.iter_rows(min_row=1, max_row=ws.max_row, min_col=1, max_col=ws.max_column):
-        for cell in row:
-            cell.border = thin_border
-            if cell.row == header_row:
-                cell.font = Font(bold=True, color="000000")
-                cell.fill = HEADER_FILL
-                cell.alignment = Alignment(horizontal="center", vertical="center")
-
-    # Auto column width
-    for col in range(1, ws.max_column + 1):
-        col_letter = get_column_letter(col)
-        max_length = 0
-        for row in ws.iter_rows(min_col=col, max_col=col, values_only=True):
-            try:
-                length = len(str(row[0]))
-                if length > max_length:
-                    max_length = length
-            except:
-                pass
-        ws.column_dimensions[col_letter].width = min(max_length + 2, 50)
-
-    # Freeze header row (make header visible)
+    # Widths and panes go into the sheet header, so set them before the first append
+    col_widths = [0] * len(rows[0])
+    for row in rows:
+        for c, v in enumerate(row):
+            length = len(str(v))
+            if length > col_widths[c]:
+                col_widths[c] = length
+    for c, width in enumerate(col_widths, 1):
+        ws.column_dimensions[get_column_letter(c)].width = min(width + 2, 50)
     ws.freeze_panes = f"A{header_row+1}"
 
+    # hot loop: bind lookups to locals once instead of per cell
+    append, fill_at, new_cell = ws.append, fills.get, make_cell
+    for r, row in enumerate(rows, 1):
+        if r == header_row:
+            append([header_cell(ws, v) for v in row])
+            continue
+        out = []
+        for c, v in enumerate(row, 1):
+            fill = fill_at((r, c))
+            out.append(None if v is None and fill is None else new_cell(ws, v, fill))
+        append(out)
+
 # ====== APP ======
 st.set_page_config(page_title="Tender BoQ Comparison", layout="wide")
 
@@ -181,35 +325,44 @@ elif st.session_state["page"] == "main":
     )
 
     if uploaded_files and st.button("🔗 Merge & Compare"):
+        # parse uploads in parallel; worker threads share this run's context for st.cache_data
+        ctx = get_script_run_ctx()
+        with ThreadPoolExecutor(max_workers=min(8, len(uploaded_files)),
+                                initializer=add_script_run_ctx, initargs=(None, ctx)) as ex:
+            results = list(ex.map(load_upload, uploaded_files))
+
         all_sheets = {}
-        for uf in uploaded_files:
-            try:
-                xls = pd.ExcelFile(uf)
-                for sheet in xls.sheet_names:
-                    all_sheets.setdefault(sheet, []).append(uf)
-            except Exception as e:
-                st.error(f"Could not read file {uf.name}: {e}")
+        for file_name, book, err in results:
+            if err is not None:
+                st.error(f"Could not read file {file_name}: {err}")
+                continue
+            for sheet, df in book.items():
+                all_sheets.setdefault(sheet, []).append((file_name, df))
 
         merged_book, summary = {}, []
 
         for sheet_name, files in all_sheets.items():
             dfs = []
-            for idx, uf in enumerate(files):
-                df = pd.read_excel(uf, sheet_name=sheet_name, dtype=object)
-
+            for idx, (file_name, df) in enumerate(files):
                 unnamed_cols = [c for c in df.columns if str(c).startswith("Unnamed")]
+                existing = set(df.columns)
+                drop_cols, renames = [], {}
                 for c in unnamed_cols:
                     col_vals = df[c]
+                    existing.discard(c)
                     if col_vals.isna().all():
-                        df.drop(columns=[c], inplace=True)
+                        drop_cols.append(c)
                     else:
-                        new_name = uf.name.split('.')[0]
+                        new_name = file_name.split('.')[0]
                         base = new_name
                         counter = 1
-                        while new_name in df.columns:
+                        while new_name in existing:
                             new_name = f"{base}_{counter}"
                             counter += 1
-                        df.rename(columns={c: new_name}, inplace=True)
+                        existing.add(new_name)
+                        renames[c] = new_name
+                df.drop(columns=drop_cols, inplace=True)
+                df.rename(columns=renames, inplace=True)
 
                 df.dropna(axis=1, how='all', inplace=True)
 
@@ -220,87 +373,105 @@ elif st.session_state["page"] == "main":
                         df_trim = df.iloc[:, 2:].copy()
                     else:
                         df_trim = df.copy()
-                    prefix = uf.name.split('.')[0] + "_"
+                    prefix = file_name.split('.')[0] + "_"
                     df_trim = df_trim.add_prefix(prefix)
                     dfs.append(df_trim)
 
-            try:
-                merged_df = pd.concat(dfs, axis=1, ignore_index=False)
-            except Exception:
-                for i, d in enumerate(dfs):
-                    d.columns = [f"c{i}_{j}" for j in range(len(d.columns))]
-                merged_df = pd.concat(dfs, axis=1)
+            # assemble column by column instead of pd.concat; shorter sheets are padded with NaN
+            # and columns are placed by position so repeated names survive, as with concat
+            n_rows = max(len(d) for d in dfs)
+            names, columns = [], []
+            for d in dfs:
+                for j in range(d.shape[1]):
+                    col = d.iloc[:, j]
+                    if len(col) < n_rows:
+                        col = col.reset_index(drop=True).reindex(range(n_rows))
+                    names.append(d.columns[j])
+                    columns.append(col.to_numpy())
+            merged_df = pd.DataFrame(dict(enumerate(columns)), index=range(n_rows))
+            merged_df.columns = names
 
             merged_df = merged_df.loc[:, ~merged_df.columns.astype(str).str.startswith("Unnamed")]
             merged_book[sheet_name] = merged_df
 
-        bio = io.BytesIO()
-        with pd.ExcelWriter(bio, engine="openpyxl") as writer:
-            for sheet, df in merged_book.items():
-                df.to_excel(writer, sheet_name=sheet, index=False)
-        bio.seek(0)
-        merged_data = bio.getvalue()
+        wb = Workbook(write_only=True)
+        wb.add_named_style(NamedStyle(name=BORDERED_STYLE, border=thin_border))
 
-        wb = load_workbook(io.BytesIO(merged_data))
+        for sheet_name, merged_df in merged_book.items():
+            ws = wb.create_sheet(sheet_name)
+            rows = frame_rows(merged_df)
 
-        for sheet_name in wb.sheetnames:
-            ws = wb[sheet_name]
-            df0 = pd.read_excel(io.BytesIO(merged_data), sheet_name=sheet_name, header=None, dtype=object)
-            header_row = detect_header_row(df0)
+            header_row = detect_header_row(pd.DataFrame(rows[:HEADER_SEARCH_ROWS]))
             if header_row is None:
+                for row in rows:
+                    ws.append(row)
                 continue
             header_excel_row = header_row + 1
 
-            headers = [str(ws.cell(row=header_excel_row, column=c).value or "").strip()
-                       for c in range(1, ws.max_column + 1)]
+            # classify header cells in one pass
+            col_kinds = {"amt": [], "rate": [], "qty": []}
+            for i, v in enumerate(rows[header_row], 1):
+                for kind in {m.lastgroup for m in COLUMN_PATTERN.finditer(str(v or "").strip())}:
+                    col_kinds[kind].append(i)
+            amount_cols, rate_cols, qty_cols = col_kinds["amt"], col_kinds["rate"], col_kinds["qty"]
 
-            amount_cols = [i for i, h in enumerate(headers, 1) if AMOUNT_PATTERN.search(h)]
             if not amount_cols:
+                for row in rows:
+                    ws.append(row)
                 continue
             if take_first_three_only and len(amount_cols) > 3:
                 amount_cols = amount_cols[:3]
 
-            # find rate & qty cols
-            rate_cols = [i for i, h in enumerate(headers, 1) if RATE_PATTERN.search(h)]
-            qty_cols  = [i for i, h in enumerate(headers, 1) if QTY_PATTERN.search(h)]
-
-            low_count, high_count, missing_count, mismatch_count = 0, 0, 0, 0
-            for r in range(header_excel_row + 1, ws.max_row + 1):
-                vals = [to_number(ws.cell(row=r, column=c).value) for c in amount_cols]
-                present = [v for v in vals if v is not None]
-                if present:
-                    mn, mx = min(present), max(present)
-                    for j, v in enumerate(vals):
-                        cell = ws.cell(row=r, column=amount_cols[j])
-                        if v is None:
-                            cell.fill = YELLOW_FILL
-                            missing_count += 1
-                        elif v == mn:
-                            cell.fill = GREEN_FILL
-                            low_count += 1
-                        elif v == mx:
-                            cell.fill = RED_FILL
-                            high_count += 1
-
-                # ---- mismatch check ----
-                if rate_cols and qty_cols and amount_cols:
-                    rate   = to_number(ws.cell(row=r, column=rate_cols[0]).value)
-                    qty    = to_number(ws.cell(row=r, column=qty_cols[0]).value)
-                    amount = to_number(ws.cell(row=r, column=amount_cols[0]).value)
-
-                    if rate is not None and qty is not None and amount is not None:
-                        expected = rate * qty
-                        if abs(expected - amount) > 1e-6:
-                            amt_cell = ws.cell(row=r, column=amount_cols[0])
-                            amt_cell.fill = BLUE_FILL
-                            mismatch_count += 1
-
-            style_worksheet(ws, header_excel_row)
+            # scan pass: count on plain values; Excel colours the all-numeric rows itself
+            data = rows[header_excel_row:]
+            first_row = header_excel_row + 1
+            A = np.column_stack([to_numbers([row[c - 1] for row in data]) for c in amount_cols])
+            missing = np.isnan(A)
+            has_value = ~missing.all(axis=1)
+            mn = np.fmin.reduce(A, axis=1)
+            mx = np.fmax.reduce(A, axis=1)
+            is_missing = missing & has_value[:, None]
+            is_low = A == mn[:, None]
+            is_high = (A == mx[:, None]) & ~is_low
+
+            low_count = int(is_low.sum())
+            high_count = int(is_high.sum())
+            missing_count = int(is_missing.sum())
+            mismatch_count = 0
+            rate_col = rate_cols[0] if rate_cols and qty_cols else None
+            qty_col  = qty_cols[0] if rate_cols and qty_cols else None
+
+            # ---- mismatch check ----
+            is_mismatch = np.zeros(len(data), dtype=bool)
+            if rate_col:
+                R = to_numbers([row[rate_col - 1] for row in data])
+                Q = to_numbers([row[qty_col - 1] for row in data])
+                amount = A[:, 0]
+                valid = ~(np.isnan(R) | np.isnan(Q) | np.isnan(amount))
+                is_mismatch = valid & (np.abs(R * Q - amount) > 1e-6)
+                mismatch_count = int(is_mismatch.sum())
+
+            # rows with text in a compared cell are skipped by the rules, so fill those here
+            textual = text_rows(data, amount_cols + ([rate_col, qty_col] if rate_col else []))
+            fills = {}
+            for mask, fill in ((is_missing, YELLOW_FILL), (is_low, GREEN_FILL), (is_high, RED_FILL)):
+                for i, j in np.argwhere(mask & textual[:, None]).tolist():
+                    fills[(first_row + i, amount_cols[j])] = fill
+            for i in np.flatnonzero(is_mismatch & textual).tolist():
+                fills[(first_row + i, amount_cols[0])] = BLUE_FILL
+
+            # write pass: stream styled rows, then one set of rules per sheet
+            write_styled_sheet(ws, rows, header_excel_row, fills)
+            if data:
+                add_highlight_rules(ws, amount_cols, first_row, len(rows), rate_col, qty_col)
             summary.append([sheet_name, low_count, high_count, missing_count, mismatch_count])
 
+        # save in the background while the summary and previews render;
+        # the workbook is not touched again until the download button waits on it
         out_io = io.BytesIO()
-        wb.save(out_io)
-        out_io.seek(0)
+        save_pool = ThreadPoolExecutor(max_workers=1)
+        saved = save_pool.submit(wb.save, out_io)
+        save_pool.shutdown(wait=False)
 
         # Sidebar summary
         st.sidebar.subheader("📊 Summary")
@@ -322,10 +493,12 @@ elif st.session_state["page"] == "main":
         # Preview sheets
         for sheet, df in merged_book.items():
             st.subheader(f"📑 {sheet}")
-            safe_df = df.dropna(axis=1, how='all').fillna("").astype(str)
-            st.dataframe(safe_df.head(50), use_container_width=True)
+            # only the shown rows are stringified; blank columns are judged on the full sheet
+            safe_df = df.head(50).loc[:, df.notna().any()].fillna("").astype(str)
+            st.dataframe(safe_df, use_container_width=True)
 
         # Download button
+        saved.result()
         st.download_button(
             "⬇️ Download Highlighted Excel",
             data=out_io.getvalue(),